@@ -1,14 +1,29 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import asyncio
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import accumulate
+from operator import itemgetter
+from pathlib import Path
 import logging
+from cachetools import TTLCache
 from google import genai
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -28,24 +43,92 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# orjson is much faster for the small schedule arrays we (de)serialize;
+# fall back to the stdlib when it isn't installed.
+if orjson is not None:
+    json_loads = orjson.loads
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+else:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
 # --- Configuration ---
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 DEVELOPER_CHAT_ID = os.getenv("DEVELOPER_CHAT_ID")
 DB_FILE = "bot_database.db"  # Single SQLite database file
-RESPONSES_FILE = "responses.json"
+RESPONSES_FILE = Path("responses.json")
 GEM_Model = 'gemini-2.0-flash-001'
+DATE_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%H:%M"
+# Created once so its HTTP connection pool is reused across requests.
+GEMINI_CLIENT = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
+
+# --- SQL Statements ---
+# Kept as constants so SQLite's statement cache can reuse the prepared plans.
+SQL_SELECT_REMINDER_TIMES = "SELECT DISTINCT time_hhmm FROM reminders"
+SQL_SELECT_REMINDERS_AT = "SELECT user_id, name, dosage, start_date, day_start, day_end FROM reminders WHERE time_hhmm = ?"
+SQL_SELECT_SCHEDULES_FOR_USER = "SELECT name, start_date, schedule_json FROM schedules WHERE user_id = ?"
+SQL_SELECT_SCHEDULE_NAMES_FOR_USER = "SELECT name FROM schedules WHERE user_id = ?"
+# Periods active on a given day: the day offset from start_date falls in [day_start, day_end).
+SQL_SELECT_ACTIVE_TODAY = (
+    "SELECT name, dosage, time_hhmm FROM reminders WHERE user_id = :user_id "
+    "AND day_start <= julianday(:today) - julianday(start_date) "
+    "AND julianday(:today) - julianday(start_date) < day_end"
+)
+SQL_SELECT_TAKEN_TODAY = "SELECT name, taken_time FROM tracking WHERE user_id = ? AND taken_date = ?"
+SQL_INSERT_SCHEDULE = "INSERT INTO schedules (user_id, name, start_date, schedule_json) VALUES (?, ?, ?, ?)"
+SQL_INSERT_TRACK = "INSERT OR IGNORE INTO tracking (user_id, name, taken_date, taken_time, logged_at) VALUES (?, ?, ?, ?, ?)"
+SQL_INSERT_REMINDER = (
+    "INSERT INTO reminders (schedule_id, user_id, name, start_date, period_index, day_start, day_end, time_hhmm, dosage) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_DELETE_SCHEDULE = "DELETE FROM schedules WHERE user_id = ? AND name = ?"
+SQL_DELETE_REMINDERS_FOR_SCHEDULE = (
+    "DELETE FROM reminders WHERE schedule_id IN (SELECT id FROM schedules WHERE user_id = ? AND name = ?)"
+)
 
 # --- Conversation Handler States ---
 PARSE_PILL, CONFIRM_PILL, AWAIT_CORRECTION = range(3)
 LOG_PILL_CHOICE = range(1) # State for the new logpill conversation
 
+# --- Static Keyboards ---
+# Built once and reused for every reply.
+MAIN_MENU_MARKUP = ReplyKeyboardMarkup(
+    [
+        ["/addpill", "/showpills"],
+        ["/logpill", "/todaypills"],
+        ["/deletepill"]
+    ],
+    resize_keyboard=True
+)
+YES_NO_CANCEL_MARKUP = ReplyKeyboardMarkup([["Yes"], ["No"], ["Cancel"]], one_time_keyboard=True, resize_keyboard=True)
+
+# Answers to the confirmation keyboard, matched case-insensitively.
+YES_RE = re.compile(r'^yes$', re.IGNORECASE)
+NO_RE = re.compile(r'^no$', re.IGNORECASE)
+CANCEL_RE = re.compile(r'^cancel$', re.IGNORECASE)
+
 
 # --- Database Functions ---
+# A single connection shared by all handlers, opened in init_db().
+# SQLite needs writes serialized, so every access goes through DB_LOCK.
+DB = None
+DB_LOCK = threading.Lock()
+# Every HH:MM that has at least one reminder, so check_reminders can skip
+# the query on the (many) minutes with nothing due. Rebuilt on each write.
+REMINDER_TIMES: frozenset = frozenset()
+
 def init_db():
-    """Initializes the SQLite database and creates tables if they don't exist."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    """Opens the shared SQLite connection and creates tables if they don't exist."""
+    global DB
+    DB = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    DB.execute("PRAGMA journal_mode=WAL")
+    DB.execute("PRAGMA synchronous=NORMAL")
+    DB.execute("PRAGMA temp_store=MEMORY")
+    DB.execute("PRAGMA mmap_size=67108864")
+    cursor = DB.cursor()
     # Table for storing pill schedules
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS schedules (
@@ -67,14 +150,153 @@ def init_db():
             logged_at TEXT NOT NULL
         )
     ''')
-    conn.commit()
-    conn.close()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sched_user ON schedules(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_track_user_date ON tracking(user_id, taken_date)")
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_track_dedup'")
+    if cursor.fetchone() is None:
+        # Older databases may already hold double-logged rows, which would make the
+        # unique index fail to build. Keep the earliest log of each dose; once the
+        # index exists no duplicates can appear, so this only runs on upgrade.
+        cursor.execute('''
+            DELETE FROM tracking WHERE id NOT IN (
+                SELECT MIN(id) FROM tracking GROUP BY user_id, name, taken_date, taken_time
+            )
+        ''')
+        cursor.execute("CREATE UNIQUE INDEX idx_track_dedup ON tracking(user_id, name, taken_date, taken_time)")
+    # One row per schedule period, with its day range precomputed, so the
+    # per-minute reminder check only touches the rows due at that minute.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            schedule_id INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            period_index INTEGER NOT NULL,
+            day_start INTEGER NOT NULL,
+            day_end INTEGER NOT NULL,
+            time_hhmm TEXT NOT NULL,
+            dosage TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_time ON reminders(time_hhmm)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_schedule ON reminders(schedule_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders(user_id)")
+    # Backfill reminders for schedules saved before the table existed.
+    cursor.execute("SELECT id, user_id, name, start_date, schedule_json FROM schedules "
+                   "WHERE id NOT IN (SELECT schedule_id FROM reminders)")
+    for schedule_id, user_id, name, start_date, schedule_json in cursor.fetchall():
+        try:
+            # Legacy rows weren't validated, so normalize the date like insert_schedules does.
+            start_date = parse_ymd(start_date).isoformat()
+            rows = build_reminder_rows(schedule_id, user_id, name, start_date, json_loads(schedule_json))
+            # One transaction per schedule, so a bad period can't leave it half backfilled.
+            with db_transaction():
+                DB.executemany(SQL_INSERT_REMINDER, rows)
+        except (ValueError, KeyError, TypeError, sqlite3.Error) as e:
+            logger.error(f"Could not build reminders for schedule {schedule_id}: {e}")
+    refresh_reminder_times()
+
+@contextmanager
+def db_transaction():
+    """Holds DB_LOCK and runs the block in a single transaction on the shared connection."""
+    with DB_LOCK:
+        DB.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            DB.execute("ROLLBACK")
+            raise
+        DB.execute("COMMIT")
+
+def refresh_reminder_times() -> None:
+    """Rebuilds REMINDER_TIMES from the reminders table."""
+    global REMINDER_TIMES
+    with DB_LOCK:
+        REMINDER_TIMES = frozenset(time for time, in DB.execute(SQL_SELECT_REMINDER_TIMES))
+
+def build_reminder_rows(schedule_id, user_id, name, start_date, schedule) -> list:
+    """Flattens a schedule into reminders rows, one per period, with cumulative day ranges."""
+    # cum_days[i] is the first day of period i; period i runs until cum_days[i + 1].
+    cum_days = list(accumulate((period['duration_days'] for period in schedule), initial=0))
+    return [
+        (schedule_id, user_id, name, start_date, period_index, day_start, day_end, period['time'], period['dosage'])
+        for period_index, (period, day_start, day_end) in enumerate(zip(schedule, cum_days, cum_days[1:]))
+    ]
+
+# Synchronous query helpers. Handlers run them via asyncio.to_thread so SQLite
+# work never blocks the event loop.
+@lru_cache(maxsize=2048)
+def parse_ymd(date_str: str):
+    """Parses a stored YYYY-MM-DD start date; the same few strings recur every minute."""
+    return datetime.strptime(date_str, DATE_FORMAT).date()
+
+def fetch_due_reminders(time_hhmm: str, today) -> list:
+    """Returns (user_id, name, dosage) for reminders at time_hhmm whose period covers today."""
+    due = []
+    with DB_LOCK:
+        # Iterate the cursor instead of fetchall() so rows outside today's
+        # window are filtered as they stream in and never collected.
+        for user_id, name, dosage, start_date_str, day_start, day_end in DB.execute(SQL_SELECT_REMINDERS_AT, (time_hhmm,)):
+            try:
+                # Negative before the start date, so day_start (>= 0) filters those out too.
+                days_since_start = (today - parse_ymd(start_date_str)).days
+            except ValueError as e:
+                logger.error(f"Bad start date for reminder '{name}' of user {user_id}: {e}")
+                continue
+            if day_start <= days_since_start < day_end:
+                due.append((user_id, name, dosage))
+    return due
+
+def insert_schedules(user_id: str, parsed_pills: list) -> None:
+    # Store start dates zero-padded (e.g. "2026-1-5" -> "2026-01-05"): strptime accepts
+    # both, but the julianday() math in SQL_SELECT_ACTIVE_TODAY only understands the padded form.
+    start_dates = [parse_ymd(pill['start_date']).isoformat() for pill in parsed_pills]
+    rows = [(user_id, pill['name'], start_date, json_dumps(pill['schedule']))
+            for pill, start_date in zip(parsed_pills, start_dates)]
+    # Each schedule's id is needed for its reminders rows, so the schedules
+    # are inserted one by one, but everything still lands in one commit.
+    with db_transaction():
+        for row, pill, start_date in zip(rows, parsed_pills, start_dates):
+            schedule_id = DB.execute(SQL_INSERT_SCHEDULE, row).lastrowid
+            DB.executemany(SQL_INSERT_REMINDER, build_reminder_rows(
+                schedule_id, user_id, pill['name'], start_date, pill['schedule']))
+    refresh_reminder_times()
+
+def fetch_active_periods(user_id: str, today_str: str) -> list:
+    with DB_LOCK:
+        return DB.execute(SQL_SELECT_ACTIVE_TODAY, {"user_id": user_id, "today": today_str}).fetchall()
+
+def fetch_taken_today(user_id: str, today_str: str) -> set:
+    """Returns the (name, time) pairs the user has already logged for the day."""
+    with DB_LOCK:
+        return set(DB.execute(SQL_SELECT_TAKEN_TODAY, (user_id, today_str)).fetchall())
+
+def insert_tracking(user_id: str, name: str, taken_date: str, taken_time: str, logged_at: str) -> bool:
+    """Logs a taken pill. Returns False if that dose was already logged (idx_track_dedup)."""
+    with DB_LOCK:
+        return DB.execute(SQL_INSERT_TRACK, (user_id, name, taken_date, taken_time, logged_at)).rowcount > 0
+
+def fetch_schedules(user_id: str) -> list:
+    with DB_LOCK:
+        return DB.execute(SQL_SELECT_SCHEDULES_FOR_USER, (user_id,)).fetchall()
+
+def fetch_schedule_names(user_id: str) -> list:
+    with DB_LOCK:
+        return DB.execute(SQL_SELECT_SCHEDULE_NAMES_FOR_USER, (user_id,)).fetchall()
+
+def delete_schedule(user_id: str, name: str) -> int:
+    """Deletes a schedule and its reminders, returning the number of schedules removed."""
+    with db_transaction():
+        DB.execute(SQL_DELETE_REMINDERS_FOR_SCHEDULE, (user_id, name))
+        deleted = DB.execute(SQL_DELETE_SCHEDULE, (user_id, name)).rowcount
+    refresh_reminder_times()
+    return deleted
 
 def load_responses():
     """Loads bot responses from the JSON file."""
     try:
-        with open(RESPONSES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return json_loads(RESPONSES_FILE.read_bytes())
     except FileNotFoundError:
         logger.error(f"FATAL: {RESPONSES_FILE} not found.")
         return None
@@ -83,48 +305,66 @@ responses = load_responses()
 if responses is None:
     exit()
 
+# Every response the handlers use, bound once so handlers skip the dict lookup
+# and a key missing from responses.json fails at startup, not mid-conversation.
+RESP_START_COMMAND = responses["start_command"]
+RESP_ADDPILL_INITIAL = responses["addpill_initial"]
+RESP_ANALYZING_TEXT = responses["analyzing_text"]
+RESP_PARSE_ERROR = responses["parse_error"]
+RESP_CONFIRMATION_PROMPT = responses["confirmation_prompt"]
+RESP_CORRECTION_PROMPT = responses["correction_prompt"]
+RESP_SAVE_SUCCESS = responses["save_success"]
+RESP_SAVE_ERROR = responses["save_error"]
+RESP_ACTION_CANCELLED = responses["action_cancelled"]
+RESP_NO_REMINDERS_SHOW = responses["no_reminders_show"]
+RESP_SHOWPILLS_HEADER = responses["showpills_header"]
+RESP_NO_REMINDERS_TODAY = responses["no_reminders_today"]
+RESP_TODAYPILLS_HEADER = responses["todaypills_header"]
+RESP_NO_REMINDERS_DELETE = responses["no_reminders_delete"]
+RESP_DELETEPILL_PROMPT = responses["deletepill_prompt"]
+RESP_DELETE_SUCCESS = responses["delete_success"]
+RESP_DELETE_ERROR = responses["delete_error"]
+RESP_GENERIC_ERROR = responses["generic_error"]
+
 # --- Reminder & Tracking Logic ---
 
 async def check_reminders(context: ContextTypes.DEFAULT_TYPE):
     """Checks for reminders and sends them with an inline button."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, name, start_date, schedule_json FROM schedules")
-    all_schedules = cursor.fetchall()
-    conn.close()
-    
     now = datetime.now()
-    current_time_str = now.strftime("%H:%M")
+    current_time_str = now.strftime(TIME_FORMAT)
+    if current_time_str not in REMINDER_TIMES:
+        return
 
-    for user_id, name, start_date_str, schedule_json in all_schedules:
+    due_reminders = await asyncio.to_thread(fetch_due_reminders, current_time_str, now.date())
+
+    sends = []
+    recipients = []
+    for user_id, name, dosage in due_reminders:
         try:
-            schedule = json.loads(schedule_json)
-            start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-            if now < start_date:
-                continue
-            days_since_start = (now - start_date).days
-            cumulative_days = 0
-            for period in schedule:
-                duration = period['duration_days']
-                if cumulative_days <= days_since_start < cumulative_days + duration:
-                    if period['time'] == current_time_str:
-                        message = f"🔔 Reminder: It's time for your '{name}'!\n\n" \
-                                  f"Dosage/Task: {period['dosage']}"
-                        
-                        callback_data = f"take|{name}|{period['time']}"
-                        keyboard = [[InlineKeyboardButton("✅ Mark as Taken", callback_data=callback_data)]]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-
-                        await context.bot.send_message(
-                            chat_id=user_id, 
-                            text=message,
-                            reply_markup=reply_markup
-                        )
-                    break
-                cumulative_days += duration
+            message = f"🔔 Reminder: It's time for your '{name}'!\n\n" \
+                      f"Dosage/Task: {dosage}"
+
+            callback_data = f"take|{name}|{current_time_str}"
+            keyboard = [[InlineKeyboardButton("✅ Mark as Taken", callback_data=callback_data)]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+
+            sends.append(context.bot.send_message(
+                chat_id=user_id, 
+                text=message,
+                reply_markup=reply_markup
+            ))
+            recipients.append(user_id)
         except Exception as e:
             logger.error(f"Error processing reminder for user {user_id}: {e}")
 
+    # Send this minute's reminders concurrently instead of one round-trip at a time.
+    # The Application's AIORateLimiter keeps the burst under Telegram's flood
+    # limits and retries RetryAfter, so busy minutes like 08:00 aren't dropped.
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    for user_id, result in zip(recipients, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error sending reminder to user {user_id}: {result}")
+
 # --- Helper Function ---
 def clean_user_context(context: ContextTypes.DEFAULT_TYPE):
     keys_to_delete = ['parsed_pills', 'pill_conversation_history']
@@ -132,36 +372,86 @@ def clean_user_context(context: ContextTypes.DEFAULT_TYPE):
         if key in context.user_data:
             del context.user_data[key]
 
+# Today's active (name, dosage, time) periods per (user_id, day). /logpill and
+# /todaypills (and the inline button refresh) often hit this back to back.
+# Only touched from the event loop, since TTLCache is not thread-safe.
+ACTIVE_PERIODS_CACHE = TTLCache(maxsize=10_000, ttl=60)
+
+async def get_active_periods(user_id: str, today_str: str) -> list:
+    """Returns the user's periods active on the given day, cached for a short TTL."""
+    key = (user_id, today_str)
+    active_periods = ACTIVE_PERIODS_CACHE.get(key)
+    if active_periods is None:
+        active_periods = await asyncio.to_thread(fetch_active_periods, user_id, today_str)
+        ACTIVE_PERIODS_CACHE[key] = active_periods
+    return active_periods
+
+def invalidate_active_periods(user_id: str):
+    """Drops the user's cached active periods after their schedules change."""
+    ACTIVE_PERIODS_CACHE.pop((user_id, datetime.now().strftime(DATE_FORMAT)), None)
+
 
 # --- Command Handlers ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    keyboard = [
-        ["/addpill", "/showpills"],
-        ["/logpill", "/todaypills"],
-        ["/deletepill"]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_html(
-        responses["start_command"].format(user_mention=user.mention_html()),
-        reply_markup=reply_markup
+        RESP_START_COMMAND.format(user_mention=user.mention_html()),
+        reply_markup=MAIN_MENU_MARKUP
     )
 
 # --- Add Pill Flow ---
 
 async def addpill_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['pill_conversation_history'] = []
-    await update.message.reply_text(responses["addpill_initial"])
+    await update.message.reply_text(RESP_ADDPILL_INITIAL)
     return PARSE_PILL
 
 
+def validate_parsed_pills(parsed_pills) -> None:
+    """Raises ValueError unless every pill and period has the fields the reminders table needs.
+    Integral float durations (e.g. 5.0) are converted to int in place."""
+    if not isinstance(parsed_pills, list):
+        raise ValueError("Expected a JSON array of pills")
+    for pill in parsed_pills:
+        if not isinstance(pill, dict) or not isinstance(pill.get('name'), str) or not pill['name']:
+            raise ValueError(f"Pill without a name: {pill!r}")
+        if not isinstance(pill.get('start_date'), str):
+            raise ValueError(f"Pill '{pill['name']}' has no start_date")
+        datetime.strptime(pill['start_date'], DATE_FORMAT)
+        if not isinstance(pill.get('schedule'), list):
+            raise ValueError(f"Pill '{pill['name']}' has no schedule")
+        for period in pill['schedule']:
+            if not isinstance(period, dict):
+                raise ValueError(f"Bad period for '{pill['name']}': {period!r}")
+            duration = period.get('duration_days')
+            if isinstance(duration, float) and duration.is_integer():
+                duration = period['duration_days'] = int(duration)
+            if not isinstance(duration, int) or isinstance(duration, bool) or duration < 0:
+                raise ValueError(f"Bad duration_days for '{pill['name']}': {duration!r}")
+            if not isinstance(period.get('time'), str) or not period['time']:
+                raise ValueError(f"Missing time for '{pill['name']}'")
+            dosage = period.get('dosage')
+            if not isinstance(dosage, (str, int, float)) or isinstance(dosage, bool):
+                raise ValueError(f"Bad dosage for '{pill['name']}': {dosage!r}")
+
+# Cleaned Gemini replies keyed by prompt, so identical prompts (same conversation,
+# same day) skip another model call. Only replies that parsed to a valid, non-empty
+# schedule are stored, so a bad reply never blocks the user's retry.
+# Only touched from the event loop, since TTLCache is not thread-safe.
+GEMINI_REPLY_CACHE = TTLCache(maxsize=1024, ttl=24 * 60 * 60)
+
+def generate_schedule_text(prompt: str) -> str:
+    """Asks Gemini to parse the prompt and returns the raw reply text."""
+    response = GEMINI_CLIENT.models.generate_content(model=GEM_Model, contents=prompt)
+    return response.candidates[0].content.parts[0].text
+
 async def parse_with_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_text = update.message.text
     context.user_data['pill_conversation_history'].append(user_text)
-    await update.message.reply_text(responses["analyzing_text"], reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text(RESP_ANALYZING_TEXT, reply_markup=ReplyKeyboardRemove())
 
-    today_date = datetime.now().strftime("%Y-%m-%d")
+    today_date = datetime.now().strftime(DATE_FORMAT)
     full_conversation = "\n---\n".join(context.user_data['pill_conversation_history'])
 
     prompt = f"""
@@ -176,30 +466,34 @@ async def parse_with_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """
     
     try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        response = client.models.generate_content(model=GEM_Model, contents=prompt)
-        json_response_text = response.candidates[0].content.parts[0].text.strip().replace("```json", "").replace("```", "")
-        parsed_pills = json.loads(json_response_text)
+        json_response_text = GEMINI_REPLY_CACHE.get(prompt)
+        if json_response_text is None:
+            response_text = await asyncio.to_thread(generate_schedule_text, prompt)
+            # Strip an optional ```json ... ``` fence around the array.
+            json_response_text = response_text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+        parsed_pills = json_loads(json_response_text)
 
         if not parsed_pills:
-            await update.message.reply_text(responses["parse_error"])
+            await update.message.reply_text(RESP_PARSE_ERROR)
             clean_user_context(context)
             await start_command(update, context)
             return ConversationHandler.END
+        # Reject incomplete schedules here, before the user confirms something we can't save.
+        validate_parsed_pills(parsed_pills)
+        GEMINI_REPLY_CACHE[prompt] = json_response_text
 
         context.user_data['parsed_pills'] = parsed_pills
-        schedule_text = ""
+        parts = []
         for pill in parsed_pills:
-            schedule_text += f"*{pill['name']}* (Starts on {pill['start_date']})\n"
-            for period in pill['schedule']:
-                schedule_text += f"  - For {period['duration_days']} days: `{period['dosage']}` at `{period['time']}`\n"
-            schedule_text += "\n"
+            parts.append(f"*{pill['name']}* (Starts on {pill['start_date']})\n")
+            parts.extend(f"  - For {period['duration_days']} days: `{period['dosage']}` at `{period['time']}`\n"
+                         for period in pill['schedule'])
+            parts.append("\n")
         
-        confirmation_message = responses["confirmation_prompt"].format(schedule_text=schedule_text)
-        keyboard = [["Yes"], ["No"], ["Cancel"]]
+        confirmation_message = RESP_CONFIRMATION_PROMPT.format(schedule_text="".join(parts))
         await update.message.reply_text(
             confirmation_message,
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True),
+            reply_markup=YES_NO_CANCEL_MARKUP,
             parse_mode='Markdown'
         )
         return CONFIRM_PILL
@@ -222,13 +516,13 @@ async def parse_with_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 )
             except Exception as log_e:
                 logger.error(f"Failed to send log message to developer: {log_e}")
-        await update.message.reply_text(responses["generic_error"])
+        await update.message.reply_text(RESP_GENERIC_ERROR)
         clean_user_context(context)
         await start_command(update, context)
         return ConversationHandler.END
 
 async def handle_rejection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(responses["correction_prompt"])
+    await update.message.reply_text(RESP_CORRECTION_PROMPT)
     return AWAIT_CORRECTION
 
 async def save_confirmed_pills(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -236,27 +530,24 @@ async def save_confirmed_pills(update: Update, context: ContextTypes.DEFAULT_TYP
     parsed_pills = context.user_data.get('parsed_pills', [])
     
     if parsed_pills:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        for pill in parsed_pills:
-            cursor.execute(
-                "INSERT INTO schedules (user_id, name, start_date, schedule_json) VALUES (?, ?, ?, ?)",
-                (user_id, pill['name'], pill['start_date'], json.dumps(pill['schedule']))
-            )
-        conn.commit()
-        conn.close()
-        
-        pill_names = ', '.join([pill['name'] for pill in parsed_pills])
-        await update.message.reply_text(responses["save_success"].format(pill_names=pill_names))
+        try:
+            await asyncio.to_thread(insert_schedules, user_id, parsed_pills)
+        except Exception as e:
+            logger.error(f"Error saving pills for user {user_id}: {e}")
+            await update.message.reply_text(RESP_GENERIC_ERROR)
+        else:
+            invalidate_active_periods(user_id)
+            pill_names = ', '.join([pill['name'] for pill in parsed_pills])
+            await update.message.reply_text(RESP_SAVE_SUCCESS.format(pill_names=pill_names))
     else:
-        await update.message.reply_text(responses["save_error"])
+        await update.message.reply_text(RESP_SAVE_ERROR)
 
     clean_user_context(context)
     await start_command(update, context)
     return ConversationHandler.END
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(responses["action_cancelled"])
+    await update.message.reply_text(RESP_ACTION_CANCELLED)
     clean_user_context(context)
     await start_command(update, context)
     return ConversationHandler.END
@@ -265,39 +556,12 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # --- Log Pill Flow ---
 async def get_pending_pills(user_id: str) -> list:
     """Helper to get a list of pills scheduled for today that have not been taken."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, start_date, schedule_json FROM schedules WHERE user_id = ?", (user_id,))
-    user_items = cursor.fetchall()
-    
-    now = datetime.now()
-    today_str = now.strftime("%Y-%m-%d")
-    
-    cursor.execute("SELECT name, taken_time FROM tracking WHERE user_id = ? AND taken_date = ?", (user_id, today_str))
-    taken_pills_today = cursor.fetchall()
-    conn.close()
-    
-    taken_pills = {(name, time) for name, time in taken_pills_today}
-    
-    todays_pills = []
-    for name, start_date_str, schedule_json in user_items:
-        try:
-            start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-            if now < start_date: continue
-            
-            days_since_start = (now - start_date).days
-            cumulative_days = 0
-            schedule = json.loads(schedule_json)
-            for period in schedule:
-                duration = period['duration_days']
-                if cumulative_days <= days_since_start < cumulative_days + duration:
-                    todays_pills.append({"name": name, "time": period['time']})
-                    break
-                cumulative_days += duration
-        except Exception:
-            pass
-    
-    return [pill for pill in todays_pills if (pill['name'], pill['time']) not in taken_pills]
+    today_str = datetime.now().strftime(DATE_FORMAT)
+
+    active_periods = await get_active_periods(user_id, today_str)
+    taken_pills = await asyncio.to_thread(fetch_taken_today, user_id, today_str)
+
+    return [{"name": name, "time": time} for name, _, time in active_periods if (name, time) not in taken_pills]
 
 async def logpill_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the process of logging a pill by showing pending pills as buttons."""
@@ -309,7 +573,7 @@ async def logpill_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
 
     keyboard = []
-    for pill in sorted(pending_pills, key=lambda x: x['time']):
+    for pill in sorted(pending_pills, key=itemgetter('time')):
         button_text = f"{pill['name']} ({pill['time']})"
         keyboard.append([button_text])
     
@@ -326,7 +590,7 @@ async def log_selected_pill(update: Update, context: ContextTypes.DEFAULT_TYPE)
     choice = update.message.text
     user_id = str(update.effective_user.id)
     
-    if choice.lower() == 'cancel':
+    if choice in ("Cancel", "cancel"):
         await start_command(update, context)
         return ConversationHandler.END
 
@@ -334,20 +598,15 @@ async def log_selected_pill(update: Update, context: ContextTypes.DEFAULT_TYPE)
         pill_name, pill_time = choice.rsplit(' (', 1)
         pill_time = pill_time[:-1]
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        logged_at_timestamp = datetime.now().isoformat()
-        
-        cursor.execute("INSERT INTO tracking (user_id, name, taken_date, taken_time, logged_at) VALUES (?, ?, ?, ?, ?)",
-                       (user_id, pill_name, today_str, pill_time, logged_at_timestamp))
-        conn.commit()
-        conn.close()
-        
-        await update.message.reply_text(f"✅ Logged '{pill_name}' as taken!")
+        now = datetime.now()
+        today_str = now.strftime(DATE_FORMAT)
+        logged_at_timestamp = now.isoformat()
+
+        if await asyncio.to_thread(insert_tracking, user_id, pill_name, today_str, pill_time, logged_at_timestamp):
+            await update.message.reply_text(f"✅ Logged '{pill_name}' as taken!")
+        else:
+            await update.message.reply_text(f"'{pill_name}' was already logged for that time.")
 
-    except sqlite3.IntegrityError: # This would be better with a UNIQUE constraint
-         await update.message.reply_text(f"'{pill_name}' was already logged for that time.")
     except Exception as e:
         logger.error(f"Error logging selected pill: {e}")
         await update.message.reply_text("Sorry, an error occurred. Please try again.")
@@ -361,59 +620,29 @@ async def log_selected_pill(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def todaypills_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Generates and shows the interactive list of today's pills."""
     user_id = str(update.effective_user.id)
-    message, reply_markup = await get_todaypills_message(user_id)
+    message, reply_markup = await get_todaypills_message(user_id, datetime.now().strftime(DATE_FORMAT))
     await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
-async def get_todaypills_message(user_id: str):
+async def get_todaypills_message(user_id: str, today_str: str):
     """Helper function to build the message and keyboard for /todaypills."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, start_date, schedule_json FROM schedules WHERE user_id = ?", (user_id,))
-    user_items = cursor.fetchall()
-    
-    now = datetime.now()
-    today_str = now.strftime("%Y-%m-%d")
-    
-    cursor.execute("SELECT name, taken_time FROM tracking WHERE user_id = ? AND taken_date = ?", (user_id, today_str))
-    taken_pills_today = cursor.fetchall()
-    conn.close()
-
-    taken_pills = {(name, time) for name, time in taken_pills_today}
-    
-    todays_pills = []
-    for name, start_date_str, schedule_json in user_items:
-        try:
-            start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-            if now < start_date: continue
-            
-            days_since_start = (now - start_date).days
-            cumulative_days = 0
-            schedule = json.loads(schedule_json)
-            for period in schedule:
-                duration = period['duration_days']
-                if cumulative_days <= days_since_start < cumulative_days + duration:
-                    todays_pills.append({"name": name, "dosage": period['dosage'], "time": period['time']})
-                    break
-                cumulative_days += duration
-        except Exception as e:
-            logger.error(f"Could not process item '{name}' for /todaypills: {e}")
-
-    if not todays_pills:
-        return responses["no_reminders_today"], None
-
-    message_lines = [responses["todaypills_header"]]
-    keyboard = []
-    
-    for pill in sorted(todays_pills, key=lambda x: x['time']):
-        pill_id = f"{pill['name']}|{pill['time']}"
-        if (pill['name'], pill['time']) in taken_pills:
-            status_icon = "✅"
-            message_lines.append(f"{status_icon} *{pill['name']}* - `{pill['dosage']}` at `{pill['time']}` (Taken)")
-        else:
-            status_icon = "⚪️"
-            message_lines.append(f"{status_icon} *{pill['name']}* - `{pill['dosage']}` at `{pill['time']}` (Pending)")
-            callback_data = f"take|{pill_id}"
-            keyboard.append([InlineKeyboardButton(f"✅ Mark '{pill['name']}' as Taken", callback_data=callback_data)])
+    active_periods = await get_active_periods(user_id, today_str)
+    taken_pills = await asyncio.to_thread(fetch_taken_today, user_id, today_str)
+
+    if not active_periods:
+        return RESP_NO_REMINDERS_TODAY, None
+
+    # (name, dosage, time) tuples, ordered by time.
+    todays_pills = sorted(active_periods, key=itemgetter(2))
+    message_lines = [RESP_TODAYPILLS_HEADER]
+    message_lines.extend(
+        f"✅ *{name}* - `{dosage}` at `{time}` (Taken)" if (name, time) in taken_pills
+        else f"⚪️ *{name}* - `{dosage}` at `{time}` (Pending)"
+        for name, dosage, time in todays_pills
+    )
+    keyboard = [
+        [InlineKeyboardButton(f"✅ Mark '{name}' as Taken", callback_data=f"take|{name}|{time}")]
+        for name, _, time in todays_pills if (name, time) not in taken_pills
+    ]
     
     return "\n".join(message_lines), InlineKeyboardMarkup(keyboard) if keyboard else None
 
@@ -426,18 +655,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         action, pill_name, pill_time = query.data.split('|', 2)
         user_id = str(query.from_user.id)
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        logged_at_timestamp = datetime.now().isoformat()
+        now = datetime.now()
+        today_str = now.strftime(DATE_FORMAT)
+        logged_at_timestamp = now.isoformat()
 
         if action == 'take':
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO tracking (user_id, name, taken_date, taken_time, logged_at) VALUES (?, ?, ?, ?, ?)",
-                           (user_id, pill_name, today_str, pill_time, logged_at_timestamp))
-            conn.commit()
-            conn.close()
+            # A repeated press is ignored by the insert; either way, refresh the list.
+            await asyncio.to_thread(insert_tracking, user_id, pill_name, today_str, pill_time, logged_at_timestamp)
             
-            message, reply_markup = await get_todaypills_message(user_id)
+            message, reply_markup = await get_todaypills_message(user_id, today_str)
             await query.edit_message_text(text=message, reply_markup=reply_markup, parse_mode='Markdown')
     
     except Exception as e:
@@ -448,40 +674,31 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # --- Other Commands ---
 async def showpills_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(update.effective_user.id)
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, start_date, schedule_json FROM schedules WHERE user_id = ?", (user_id,))
-    user_items = cursor.fetchall()
-    conn.close()
+    user_items = await asyncio.to_thread(fetch_schedules, user_id)
 
     if not user_items:
-        await update.message.reply_text(responses["no_reminders_show"])
+        await update.message.reply_text(RESP_NO_REMINDERS_SHOW)
         return
         
-    message = responses["showpills_header"]
+    parts = [RESP_SHOWPILLS_HEADER]
     for i, (name, start_date, schedule_json) in enumerate(user_items, 1):
-        message += f"*{i}. {name}* (Starts on {start_date})\n"
-        schedule = json.loads(schedule_json)
-        for period in schedule:
-            message += f"  - For {period['duration_days']} days: `{period['dosage']}` at `{period['time']}`\n"
-        message += "\n"
-    await update.message.reply_text(message, parse_mode='Markdown')
+        parts.append(f"*{i}. {name}* (Starts on {start_date})\n")
+        parts.extend(f"  - For {period['duration_days']} days: `{period['dosage']}` at `{period['time']}`\n"
+                     for period in json_loads(schedule_json))
+        parts.append("\n")
+    await update.message.reply_text("".join(parts), parse_mode='Markdown')
 
 async def deletepill_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = str(update.effective_user.id)
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM schedules WHERE user_id = ?", (user_id,))
-    user_items = cursor.fetchall()
-    conn.close()
+    user_items = await asyncio.to_thread(fetch_schedule_names, user_id)
 
     if not user_items:
-        await update.message.reply_text(responses["no_reminders_delete"])
+        await update.message.reply_text(RESP_NO_REMINDERS_DELETE)
         return ConversationHandler.END
         
     keyboard = [[item[0]] for item in user_items]
     await update.message.reply_text(
-        responses["deletepill_prompt"],
+        RESP_DELETEPILL_PROMPT,
         reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, input_field_placeholder="Select a pill to remove"),
     )
     return 0
@@ -490,16 +707,13 @@ async def delete_selected_pill(update: Update, context: ContextTypes.DEFAULT_TYP
     choice = update.message.text
     user_id = str(update.effective_user.id)
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM schedules WHERE user_id = ? AND name = ?", (user_id, choice))
-    conn.commit()
-    conn.close()
+    deleted = await asyncio.to_thread(delete_schedule, user_id, choice)
+    invalidate_active_periods(user_id)
 
-    if cursor.rowcount > 0:
-        await update.message.reply_text(responses["delete_success"].format(choice=choice))
+    if deleted > 0:
+        await update.message.reply_text(RESP_DELETE_SUCCESS.format(choice=choice))
     else:
-        await update.message.reply_text(responses["delete_error"])
+        await update.message.reply_text(RESP_DELETE_ERROR)
         
     await start_command(update, context)
     return ConversationHandler.END
@@ -510,7 +724,12 @@ def main() -> None:
     if not TELEGRAM_TOKEN or not GEMINI_API_KEY:
         logger.error("FATAL: Missing API keys in .env file.")
         return
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .build()
+    )
     job_queue = application.job_queue
     job_queue.run_repeating(check_reminders, interval=60, first=10)
     
@@ -519,9 +738,9 @@ def main() -> None:
         states={
             PARSE_PILL: [MessageHandler(filters.TEXT & ~filters.COMMAND, parse_with_gemini)],
             CONFIRM_PILL: [
-                MessageHandler(filters.Regex('^(Yes|yes)$'), save_confirmed_pills),
-                MessageHandler(filters.Regex('^(No|no)$'), handle_rejection),
-                MessageHandler(filters.Regex('^(Cancel|cancel)$'), cancel_command)
+                MessageHandler(filters.Regex(YES_RE), save_confirmed_pills),
+                MessageHandler(filters.Regex(NO_RE), handle_rejection),
+                MessageHandler(filters.Regex(CANCEL_RE), cancel_command)
             ],
             AWAIT_CORRECTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, parse_with_gemini)]
         },